@@ -1,31 +1,66 @@
 import os
-import tempfile
-from PIL import Image
-import streamlit as st
-import pandas as pd
+
+# Keep OpenMP from spreading small single-image work over every core; this must
+# run before cv2/torch are imported here or in utils
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
+import cv2
+cv2.setNumThreads(1)
+
 import io
-from utils import detect_and_process_id_card
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from PIL import Image
+from utils import detect_and_process_id_card, decode_image, get_models, GPU_AVAILABLE, DEBUG
+from storage import load_data, save_data, rows_to_dataframe, excel_bytes
 
 # Streamlit configuration
 st.set_page_config(page_title='Egyptian ID OCR', page_icon='💳', layout='wide')
 
-# --- PERSISTENCE LOGIC ---
-DB_FILE = "database.xlsx"
+# Full OCR pipeline keyed on the encoded image bytes; the same photo submitted
+# again (another session, a re-upload) returns the stored result instantly
+@st.cache_data(show_spinner=False, max_entries=32)
+def scan_image_bytes(image_bytes, use_gpu):
+    return detect_and_process_id_card(decode_image(image_bytes), use_gpu)
 
-def load_data():
-    if os.path.exists(DB_FILE):
-        try:
-            return pd.read_excel(DB_FILE)
-        except Exception:
-            return pd.DataFrame(columns=['First Name', 'Second Name', 'Full Name', 'National ID', 'Address', 'Birth Date', 'Governorate', 'Gender'])
-    return pd.DataFrame(columns=['First Name', 'Second Name', 'Full Name', 'National ID', 'Address', 'Birth Date', 'Governorate', 'Gender'])
+# One warm OCR worker per Streamlit process, shared by all sessions; the models
+# it uses are process-wide singletons as well
+@st.cache_resource
+def get_ocr_pool():
+    return ThreadPoolExecutor(max_workers=1)
+
+# Show the scan status and poll the background job; only this fragment reruns
+# until the job finishes, then the full page reruns to show the results
+@st.fragment(run_every=0.2)
+def scan_status():
+    if st.session_state.scan_future.done():
+        st.rerun()
+    st.info("🔍 Scanning ID Card...")
+
+# Longest side of on-screen image previews
+PREVIEW_SIZE = (600, 600)
 
-def save_data(df):
-    df.to_excel(DB_FILE, index=False)
+# Open a JPEG for display at reduced size. draft() lets libjpeg scale during the
+# IDCT, so only a fraction of the pixels are decoded; do not copy() before
+# thumbnail() or the full image gets decoded anyway. Returning JPEG bytes lets
+# st.image send them as-is instead of re-encoding a PNG on every rerun.
+def load_preview(path):
+    preview = Image.open(path)
+    preview.draft("RGB", PREVIEW_SIZE)
+    preview.thumbnail(PREVIEW_SIZE, Image.BILINEAR)
+    buffer = io.BytesIO()
+    preview.save(buffer, "JPEG", quality=80)
+    return buffer.getvalue()
 
 # Initialize session state
-if 'id_database' not in st.session_state:
-    st.session_state.id_database = load_data()
+# Records are kept as a list of dicts plus a set of national IDs so a save is an
+# append and the duplicate check is a set lookup
+if 'id_rows' not in st.session_state:
+    st.session_state.id_rows = load_data().to_dict('records')
+    st.session_state.id_set = {str(row['National ID']) for row in st.session_state.id_rows}
 
 if "current_tab" not in st.session_state:
     st.session_state.current_tab = "Home"
@@ -36,6 +71,36 @@ if 'captured_image' not in st.session_state:
 if 'is_confirmed' not in st.session_state:
     st.session_state.is_confirmed = False
 
+if 'use_gpu' not in st.session_state:
+    st.session_state.use_gpu = GPU_AVAILABLE
+
+if 'scan_key' not in st.session_state:
+    st.session_state.scan_key = None
+    st.session_state.scan_future = None
+
+if 'xlsx_export' not in st.session_state:
+    st.session_state.xlsx_export = None
+
+# Load the models once per process up front, so the first scan does not wait
+# for them; later reruns get the cached instances back immediately
+with st.spinner("Loading models..."):
+    get_models(st.session_state.use_gpu)
+
+# Static User Guide text, built once at import
+GUIDE_MD = """
+### Steps to use:
+1. **Choose Input**: Use 'Camera Capture' for real-time scanning or 'File Upload' for saved images.
+2. **Take Photo**: Align the ID card in the frame. On mobile, use the **back camera** for best quality.
+3. **Preview**: After taking a photo, you can see it on screen.
+4. **Confirm/Retake**: If the photo is clear, click **Confirm & Scan**. If not, click **Retake**.
+5. **Review & Save**: Check the extracted text and click **Save to Database**.
+
+### Tips for Best Results:
+* **Lighting**: Avoid direct sunlight or strong glare on the card.
+* **Stability**: Hold the phone steady while capturing.
+* **Alignment**: Keep the card straight and centered.
+"""
+
 # Sidebar navigation menu
 tabs = ["Home", "Guide"]
 st.sidebar.title("Navigation")
@@ -47,6 +112,8 @@ if st.session_state.current_tab == "Home":
     # Sidebar options
     st.sidebar.subheader("Settings")
     input_method = st.sidebar.radio("Input Method", ["Camera Capture", "File Upload"])
+    st.session_state.use_gpu = st.sidebar.checkbox("Use GPU", value=st.session_state.use_gpu, disabled=not GPU_AVAILABLE,
+                                                   help=None if GPU_AVAILABLE else "No CUDA device detected")
     
     if st.sidebar.button("🔄 Reset / New Scan"):
         st.session_state.captured_image = None
@@ -84,17 +151,24 @@ if st.session_state.current_tab == "Home":
             final_image_file = st.session_state.captured_image
 
     # Processing and Results
+    # OCR runs on a background worker. The job is keyed on the image bytes, so
+    # reruns (widget clicks, the Save button) reuse the result instead of
+    # scanning again, and the page stays responsive while the scan is running.
     if final_image_file and st.session_state.is_confirmed:
-        with st.spinner("🔍 Scanning ID Card..."):
-            try:
-                # Save to temporary file for processing
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-                    tmp.write(final_image_file.getvalue())
-                    tmp_path = tmp.name
-
-                # Perform OCR
-                results_data = detect_and_process_id_card(tmp_path)
-                
+        try:
+            image_data = final_image_file.getvalue()
+            scan_key = hashlib.md5(image_data).hexdigest()
+            if st.session_state.scan_key != scan_key:
+                # Decode and OCR the image on the worker thread
+                st.session_state.scan_future = get_ocr_pool().submit(
+                    scan_image_bytes, image_data, st.session_state.use_gpu)
+                st.session_state.scan_key = scan_key
+
+            if not st.session_state.scan_future.done():
+                scan_status()
+            else:
+                results_data = st.session_state.scan_future.result()
+
                 # Unpack results
                 f_name, s_name, full_name, n_id, addr, bday, gov, gen = results_data
 
@@ -104,6 +178,7 @@ if st.session_state.current_tab == "Home":
                     if st.button("Try Again"):
                         st.session_state.captured_image = None
                         st.session_state.is_confirmed = False
+                        st.session_state.scan_key = None
                         st.rerun()
                 else:
                     results_dict = {
@@ -117,9 +192,9 @@ if st.session_state.current_tab == "Home":
                         'Gender': gen
                     }
 
-                    # Display Processed Image (if available from utils)
-                    if os.path.exists("d2.jpg"):
-                        st.image("d2.jpg", caption="Detection Results", use_container_width=True)
+                    # Display Processed Image (written by utils in debug mode only)
+                    if DEBUG and os.path.exists("d2.jpg"):
+                        st.image(load_preview("d2.jpg"), caption="Detection Results")
 
                     st.success("✅ Extraction Complete!")
                     
@@ -129,27 +204,29 @@ if st.session_state.current_tab == "Home":
                         st.write(f"**{key}:** {val}")
 
                     # Save Button
-                    if st.button("💾 Save to Excel Database", use_container_width=True):
-                        # Duplicate check
-                        db = st.session_state.id_database
-                        if str(n_id) in db['National ID'].astype(str).values:
-                            st.warning(f"⚠️ ID {n_id} already exists in the database.")
+                    if st.button("💾 Save to Database", use_container_width=True):
+                        # Duplicate check (the primary key also rejects IDs saved elsewhere).
+                        # Storage errors are reported here, not as a failed scan below.
+                        try:
+                            duplicate = str(n_id) in st.session_state.id_set or not save_data(results_dict)
+                        except sqlite3.Error as e:
+                            st.error(f"❌ Could not save to the database: {str(e)}")
                         else:
-                            new_row = pd.DataFrame([results_dict])
-                            st.session_state.id_database = pd.concat([db, new_row], ignore_index=True)
-                            save_data(st.session_state.id_database)
-                            st.success("🎉 Data saved successfully!")
-
-            except Exception as e:
-                st.error(f"❌ Error: {str(e)}")
-                st.info("This error usually happens if the ID card is not detected. Please try to take a clearer photo.")
-                if st.button("Retry"):
-                    st.session_state.captured_image = None
-                    st.session_state.is_confirmed = False
-                    st.rerun()
-            finally:
-                if 'tmp_path' in locals() and os.path.exists(tmp_path):
-                    os.remove(tmp_path)
+                            if duplicate:
+                                st.warning(f"⚠️ ID {n_id} already exists in the database.")
+                            else:
+                                st.session_state.id_rows.append(results_dict)
+                                st.session_state.id_set.add(str(n_id))
+                                st.success("🎉 Data saved successfully!")
+
+        except Exception as e:
+            st.error(f"❌ Error: {str(e)}")
+            st.info("This error usually happens if the ID card is not detected. Please try to take a clearer photo.")
+            if st.button("Retry"):
+                st.session_state.captured_image = None
+                st.session_state.is_confirmed = False
+                st.session_state.scan_key = None
+                st.rerun()
 
     elif not final_image_file and not st.session_state.is_confirmed:
         # Welcome screen / Placeholder
@@ -159,33 +236,25 @@ if st.session_state.current_tab == "Home":
             st.info("Welcome! Please capture a photo or upload an image to start scanning.")
 
     # Show Database
-    if not st.session_state.id_database.empty:
+    if st.session_state.id_rows:
+        id_database = rows_to_dataframe(st.session_state.id_rows)
         st.markdown("---")
         st.subheader("📋 Saved Records")
-        st.dataframe(st.session_state.id_database, use_container_width=True)
+        st.dataframe(id_database, use_container_width=True)
         
-        # Download
-        buffer = io.BytesIO()
-        st.session_state.id_database.to_excel(buffer, index=False)
-        st.download_button(
-            label="📥 Download Excel Report",
-            data=buffer.getvalue(),
-            file_name="id_records.xlsx",
-            mime="application/vnd.ms-excel"
-        )
+        # Download: the xlsx is only built when asked for, not on every rerun.
+        # Records are only ever appended, so the row count identifies the export.
+        if st.button("📥 Prepare Excel Report"):
+            st.session_state.xlsx_export = (len(id_database), excel_bytes(id_database))
+        export = st.session_state.xlsx_export
+        if export and export[0] == len(st.session_state.id_rows):
+            st.download_button(
+                label="📥 Download Excel Report",
+                data=export[1],
+                file_name="id_records.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
 
 elif st.session_state.current_tab == "Guide":
     st.title("📖 User Guide")
-    st.markdown("""
-    ### Steps to use:
-    1. **Choose Input**: Use 'Camera Capture' for real-time scanning or 'File Upload' for saved images.
-    2. **Take Photo**: Align the ID card in the frame. On mobile, use the **back camera** for best quality.
-    3. **Preview**: After taking a photo, you can see it on screen.
-    4. **Confirm/Retake**: If the photo is clear, click **Confirm & Scan**. If not, click **Retake**.
-    5. **Review & Save**: Check the extracted text and click **Save to Excel Database**.
-    
-    ### Tips for Best Results:
-    * **Lighting**: Avoid direct sunlight or strong glare on the card.
-    * **Stability**: Hold the phone steady while capturing.
-    * **Alignment**: Keep the card straight and centered.
-    """)
+    st.markdown(GUIDE_MD)
@@ -0,0 +1,105 @@
+import os
+import io
+import sqlite3
+from contextlib import closing
+import openpyxl
+import pandas as pd
+import streamlit as st
+
+# Records live in SQLite with the national ID as primary key, so a save is a
+# single INSERT; Excel is only produced for the download button
+DB_FILE = "database.sqlite"
+LEGACY_DB_FILE = "database.xlsx"
+COLUMNS = ['First Name', 'Second Name', 'Full Name', 'National ID', 'Address', 'Birth Date', 'Governorate', 'Gender']
+DB_COLUMNS = ['first_name', 'second_name', 'full_name', 'national_id', 'address', 'birth_date', 'governorate', 'gender']
+
+# Open the database, creating the table on first use
+def connect_db():
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute("CREATE TABLE IF NOT EXISTS ids (first_name TEXT, second_name TEXT, full_name TEXT, "
+                 "national_id TEXT PRIMARY KEY, address TEXT, birth_date TEXT, governorate TEXT, gender TEXT)")
+    return conn
+
+# Insert records, skipping national IDs that are already stored; returns the
+# number of rows actually inserted
+def insert_rows(rows):
+    values = [tuple(None if pd.isna(row[col]) else str(row[col]) for col in COLUMNS) for row in rows]
+    with closing(connect_db()) as conn:
+        with conn:
+            cursor = conn.executemany(
+                f"INSERT OR IGNORE INTO ids ({', '.join(DB_COLUMNS)}) VALUES ({', '.join('?' * len(DB_COLUMNS))})",
+                values)
+        return cursor.rowcount
+
+# Read the database once per modification time; reruns hit the cache
+@st.cache_data(show_spinner=False)
+def read_database(path, mtime):
+    with closing(sqlite3.connect(path)) as conn:
+        df = pd.read_sql_query(f"SELECT {', '.join(DB_COLUMNS)} FROM ids", conn)
+    df.columns = COLUMNS
+    return df
+
+# One-time migration from the older Excel store
+def migrate_legacy_data():
+    if os.path.exists(LEGACY_DB_FILE):
+        legacy = read_excel(LEGACY_DB_FILE)
+        insert_rows(legacy.reindex(columns=COLUMNS).to_dict('records'))
+
+def load_data():
+    if not os.path.exists(DB_FILE):
+        try:
+            migrate_legacy_data()
+        except Exception:
+            return pd.DataFrame(columns=COLUMNS)
+    if os.path.exists(DB_FILE):
+        try:
+            return read_database(DB_FILE, os.path.getmtime(DB_FILE))
+        except Exception:
+            return pd.DataFrame(columns=COLUMNS)
+    return pd.DataFrame(columns=COLUMNS)
+
+# Read an xlsx file with the Rust calamine engine, falling back to openpyxl
+# when python-calamine (or a pandas that knows it) is not installed
+def read_excel(path):
+    try:
+        return pd.read_excel(path, engine="calamine")
+    except (ImportError, ValueError):
+        return pd.read_excel(path)
+
+# Write records to xlsx with xlsxwriter in constant-memory mode, falling back
+# to openpyxl when xlsxwriter is not installed
+def write_excel(df, target):
+    try:
+        with pd.ExcelWriter(target, engine="xlsxwriter",
+                            engine_kwargs={"options": {"constant_memory": True}}) as writer:
+            df.to_excel(writer, index=False)
+    except ImportError:
+        write_excel_openpyxl(df, target)
+
+# Stream rows through openpyxl's write-only workbook (no per-value Cell objects)
+def write_excel_openpyxl(df, target):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(list(df.columns))
+    for row in df.itertuples(index=False, name=None):
+        ws.append([None if pd.isna(value) else value for value in row])
+    wb.save(target)
+
+# Serialize a records DataFrame to xlsx bytes (APP.py keeps the result in
+# session state until the records change)
+def excel_bytes(df):
+    buffer = io.BytesIO()
+    write_excel(df, buffer)
+    return buffer.getvalue()
+
+# Build a DataFrame from the saved rows only when it is displayed
+def rows_to_dataframe(rows):
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+# Insert one record; returns False when its national ID is already stored
+# (e.g. saved from another session)
+def save_data(row):
+    inserted = insert_rows([row]) > 0
+    # The new mtime already misses the cache; drop the stale copies it keyed
+    read_database.clear()
+    return inserted
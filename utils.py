@@ -1,43 +1,136 @@
+import os
+import io
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# Limit OpenMP/MKL threads before cv2/torch are imported; small per-field images
+# run slower when the thread pools spread them over every core
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
 from ultralytics import YOLO
 import cv2
 import re
+import numpy as np
+import simplejpeg
 import easyocr
+from PIL import Image
+import torch
+import streamlit as st
+
+# The cv2 calls here work on single small crops, where OpenCV's thread pool costs
+# more in fork/join than it saves
+cv2.setNumThreads(1)
+
+# Size torch's pools to match. The interop pool can only be set before torch has
+# run parallel work, which is no longer true if Streamlit reloads this module.
+# OMP_NUM_THREADS may hold an OpenMP list such as "4,2" (outer level first) or
+# be empty; fall back to one thread when it is not a number.
+try:
+    torch_threads = max(1, int(os.environ["OMP_NUM_THREADS"].split(",")[0]))
+except ValueError:
+    torch_threads = 1
+torch.set_num_threads(torch_threads)
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    pass
+
+# Set IDSCAN_DEBUG=1 to save the field-detection overlay to d2.jpg on each scan
+DEBUG = bool(os.environ.get("IDSCAN_DEBUG"))
+
+# EasyOCR runs roughly an order of magnitude faster on CUDA; use it when present
+GPU_AVAILABLE = torch.cuda.is_available()
+
+# Load the EasyOCR reader once per Streamlit process (one instance per device)
+@st.cache_resource(show_spinner=False)
+def get_reader(use_gpu=GPU_AVAILABLE):
+    use_gpu = use_gpu and GPU_AVAILABLE
+    if use_gpu:
+        # The GPU does the heavy lifting; stop CPU threads from contending
+        torch.set_num_threads(1)
+    return easyocr.Reader(['ar'], gpu=use_gpu, quantize=True, cudnn_benchmark=use_gpu)
+
+# Function to pick an exported OpenVINO model (INT8 first) next to the .pt weights
+# when one exists; see "Optional: INT8 models" in the README. OpenVINO runs on
+# the CPU, so only the CPU path uses these exports.
+def resolve_weights(weights):
+    stem = os.path.splitext(weights)[0]
+    for exported in (f"{stem}_int8_openvino_model", f"{stem}_openvino_model"):
+        if os.path.isdir(exported):
+            return exported
+    return weights
 
-# Initialize EasyOCR reader (this should be done once for efficiency)
-reader = easyocr.Reader(['ar'], gpu=False)
+# Function to get the weights path a detector loads on the chosen device
+def model_path(weights, use_gpu=GPU_AVAILABLE):
+    return weights if use_gpu else resolve_weights(weights)
+
+# Load each YOLO model once per Streamlit process and device. Ultralytics binds
+# the predictor to the device of the first predict() call, so the CPU and GPU
+# paths each need their own instance.
+@st.cache_resource(show_spinner=False)
+def get_yolo(weights, use_gpu=GPU_AVAILABLE):
+    return YOLO(model_path(weights, use_gpu), task='detect')
+
+# Weights of the three detectors: ID card, card fields and NID digits
+YOLO_WEIGHTS = ('detect_id_card.pt', 'detect_odjects.pt', 'detect_id.pt')
+
+# Function to get every model the pipeline uses (the YOLO detectors, then the
+# EasyOCR reader); all are cached, so only the first call loads anything
+def get_models(use_gpu=GPU_AVAILABLE):
+    use_gpu = use_gpu and GPU_AVAILABLE
+    return tuple(get_yolo(weights, use_gpu) for weights in YOLO_WEIGHTS) + (get_reader(use_gpu),)
+
+# Function to run a YOLO model without per-call console logging, on the device
+# the user picked. FP16 halves the tensors moved on CUDA. It is only requested
+# for .pt weights: AutoBackend would also switch an OpenVINO export to FP16.
+def predict(weights, image, use_gpu=GPU_AVAILABLE, **kwargs):
+    use_gpu = use_gpu and GPU_AVAILABLE
+    half = use_gpu and model_path(weights, use_gpu).endswith('.pt')
+    return get_yolo(weights, use_gpu).predict(image, verbose=False, half=half,
+                                              device=0 if use_gpu else 'cpu', **kwargs)
+
+# Detection settings for the small, tightly cropped field images. The defaults
+# (canvas_size=2560) size the CRAFT detector for full pages.
+READTEXT_PARAMS = dict(canvas_size=960, mag_ratio=1.0, text_threshold=0.5, low_text=0.3,
+                       link_threshold=0.1, slope_ths=0.0)
 
 # Function to preprocess the cropped image
 def preprocess_image(cropped_image):
     gray_image = cv2.cvtColor(cropped_image, cv2.COLOR_BGR2GRAY)   
     return  gray_image
 
+# Function to read single-line fields with the recognizer only. YOLO has already
+# boxed them, so EasyOCR's CRAFT text detector is skipped and all boxes are
+# recognized in one batch over the grayscale card.
+def recognize_lines(image, bboxes, use_gpu=GPU_AVAILABLE):
+    gray_image = preprocess_image(image)
+    height, width = gray_image.shape
+    boxes = [[max(0, x1), min(x2, width), max(0, y1), min(y2, height)] for x1, y1, x2, y2 in bboxes]
+    results = get_reader(use_gpu).recognize(gray_image, horizontal_list=boxes, free_list=[], detail=1,
+                                            batch_size=len(boxes), workers=0)
+    # EasyOCR sorts its output by y, so match the texts back by box corners
+    texts = {(box[0][0], box[0][1], box[2][0], box[2][1]): text for box, text, _ in results}
+    return [texts.get((x1, y1, x2, y2), '').strip() for x1, x2, y1, y2 in boxes]
+
 # Functions for specific fields with custom OCR configurations
-def extract_text(image, bbox, lang='ara'):
+# Multi-line fields (the address) have their text lines detected first
+def extract_text(image, bbox, lang='ara', use_gpu=GPU_AVAILABLE):
     x1, y1, x2, y2 = bbox
-    cropped_image = image[y1:y2, x1:x2]
-    preprocessed_image = preprocess_image(cropped_image)
-    results = reader.readtext(preprocessed_image, detail=0, paragraph=True)
-    text = ' '.join(results)
-    return text.strip()
+    preprocessed_image = preprocess_image(image[y1:y2, x1:x2])
+    results = get_reader(use_gpu).readtext(preprocessed_image, batch_size=8, workers=0, detail=0,
+                                           paragraph=True, **READTEXT_PARAMS)
+    return ' '.join(results).strip()
 
 # Function to detect national ID numbers in a cropped image
-def detect_national_id(cropped_image):
-    model = YOLO('detect_id.pt')  # Load the model directly in the function
-    results = model(cropped_image)
-    detected_info = []
-
-    for result in results:
-        for box in result.boxes:
-            cls = int(box.cls)
-            x1, y1, x2, y2 = map(int, box.xyxy[0])
-            detected_info.append((cls, x1))
-            cv2.rectangle(cropped_image, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            cv2.putText(cropped_image, str(cls), (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (36, 255, 12), 2)
-
-    detected_info.sort(key=lambda x: x[1])
-    id_number = ''.join([str(cls) for cls, _ in detected_info])
-    
-    return id_number
+# Each detected box is one digit (class id == digit); reading them left to right
+# gives the number
+def detect_national_id(cropped_image, use_gpu=GPU_AVAILABLE):
+    boxes = predict('detect_id.pt', cropped_image, use_gpu)[0].boxes
+    digits = boxes.cls.cpu().numpy().astype(np.int8)
+    order = np.argsort(boxes.xyxy[:, 0].cpu().numpy(), kind='stable')
+    return ''.join(map(str, digits[order].tolist()))
 
 # Function to remove numbers from a string
 def remove_numbers(text):
@@ -55,11 +148,17 @@ def expand_bbox_height(bbox, scale=1.2, image_shape=None):
     new_y2 = min(center_y + new_height // 2, image_shape[0])
     return [x1, new_y1, x2, new_y2]
 
+# Fields printed on a single line; they are read without text detection
+SINGLE_LINE_FIELDS = ('firstName', 'lastName', 'serial')
+
+# Threads for reading the fields of one card concurrently (the single-line
+# fields, the address and the NID digits)
+field_pool = ThreadPoolExecutor(max_workers=3)
+
 # Function to process the cropped image
-def process_image(cropped_image):
-    # Load the trained YOLO model for objects (fields) detection
-    model = YOLO('detect_odjects.pt')
-    results = model(cropped_image)
+def process_image(cropped_image, use_gpu=GPU_AVAILABLE):
+    # Detect the fields with the trained YOLO model for objects
+    results = predict('detect_odjects.pt', cropped_image, use_gpu)
 
     # Variables to store extracted values
     first_name = ''
@@ -69,29 +168,51 @@ def process_image(cropped_image):
     address = ''
     serial = ''
 
-    # Loop through the results
-    for result in results:
+    # Collect the field boxes first, then read all fields in parallel below
+    line_fields = {}
+    address_bbox = None
+    nid_bbox = None
+
+    # A single image gives a single result; pull all boxes off the device at once
+    result = results[0]
+    if DEBUG:
         output_path = 'd2.jpg'
         result.save(output_path)
 
-        for box in result.boxes:
-            bbox = box.xyxy[0].tolist()
-            class_id = int(box.cls[0].item())
-            class_name = result.names[class_id]
-            bbox = [int(coord) for coord in bbox]
-
-            if class_name == 'firstName':
-                first_name = extract_text(cropped_image, bbox, lang='ara')
-            elif class_name == 'lastName':
-                second_name = extract_text(cropped_image, bbox, lang='ara')
-            elif class_name == 'serial':
-                serial = extract_text(cropped_image, bbox, lang='eng')
-            elif class_name == 'address':
-                address = extract_text(cropped_image, bbox, lang='ara')
-            elif class_name == 'nid':
-                expanded_bbox = expand_bbox_height(bbox, scale=1.5, image_shape=cropped_image.shape)
-                cropped_nid = cropped_image[expanded_bbox[1]:expanded_bbox[3], expanded_bbox[0]:expanded_bbox[2]]
-                nid = detect_national_id(cropped_nid)
+    xyxy = result.boxes.xyxy.cpu().numpy().astype(np.int32)
+    class_ids = result.boxes.cls.cpu().numpy().astype(np.int32)
+    names = result.names
+    for class_id, bbox in zip(class_ids.tolist(), xyxy.tolist()):
+        class_name = names[class_id]
+
+        if class_name in SINGLE_LINE_FIELDS:
+            line_fields[class_name] = bbox
+        elif class_name == 'address':
+            address_bbox = bbox
+        elif class_name == 'nid':
+            nid_bbox = bbox
+
+    # Three independent jobs run side by side, as torch releases the GIL during
+    # inference: one recognizer batch over the single-line fields, the address
+    # and the NID digit detector
+    line_future = address_future = nid_future = None
+    if line_fields:
+        line_future = field_pool.submit(recognize_lines, cropped_image, list(line_fields.values()), use_gpu)
+    if address_bbox is not None:
+        address_future = field_pool.submit(extract_text, cropped_image, address_bbox, use_gpu=use_gpu)
+    if nid_bbox is not None:
+        expanded_bbox = expand_bbox_height(nid_bbox, scale=1.5, image_shape=cropped_image.shape)
+        cropped_nid = cropped_image[expanded_bbox[1]:expanded_bbox[3], expanded_bbox[0]:expanded_bbox[2]]
+        nid_future = field_pool.submit(detect_national_id, cropped_nid, use_gpu)
+
+    texts = dict(zip(line_fields, line_future.result())) if line_future is not None else {}
+    first_name = texts.get('firstName', '')
+    second_name = texts.get('lastName', '')
+    serial = texts.get('serial', '')
+    if address_future is not None:
+        address = address_future.result()
+    if nid_future is not None:
+        nid = nid_future.result()
 
     merged_name = f"{first_name} {second_name}"
     print(f"First Name: {first_name}")
@@ -101,47 +222,53 @@ def process_image(cropped_image):
     print(f"Address: {address}")
     print(f"Serial: {serial}")
 
-    decoded_info = decode_egyptian_id(nid)
-    return (first_name, second_name, merged_name, nid, address, decoded_info["Birth Date"], decoded_info["Governorate"], decoded_info["Gender"])
+    birth_date, governorate, gender = decode_egyptian_id(nid)
+    return (first_name, second_name, merged_name, nid, address, birth_date, governorate, gender)
 
-# Function to decode the Egyptian ID number
-def decode_egyptian_id(id_number):
-    governorates = {
-        '01': 'Cairo',
-        '02': 'Alexandria',
-        '03': 'Port Said',
-        '04': 'Suez',
-        '11': 'Damietta',
-        '12': 'Dakahlia',
-        '13': 'Ash Sharqia',
-        '14': 'Kaliobeya',
-        '15': 'Kafr El - Sheikh',
-        '16': 'Gharbia',
-        '17': 'Monoufia',
-        '18': 'El Beheira',
-        '19': 'Ismailia',
-        '21': 'Giza',
-        '22': 'Beni Suef',
-        '23': 'Fayoum',
-        '24': 'El Menia',
-        '25': 'Assiut',
-        '26': 'Sohag',
-        '27': 'Qena',
-        '28': 'Aswan',
-        '29': 'Luxor',
-        '31': 'Red Sea',
-        '32': 'New Valley',
-        '33': 'Matrouh',
-        '34': 'North Sinai',
-        '35': 'South Sinai',
-        '88': 'Foreign'
-    }
+# Governorate codes (digits 8-9 of the national ID)
+GOVERNORATES = {
+    '01': 'Cairo',
+    '02': 'Alexandria',
+    '03': 'Port Said',
+    '04': 'Suez',
+    '11': 'Damietta',
+    '12': 'Dakahlia',
+    '13': 'Ash Sharqia',
+    '14': 'Kaliobeya',
+    '15': 'Kafr El - Sheikh',
+    '16': 'Gharbia',
+    '17': 'Monoufia',
+    '18': 'El Beheira',
+    '19': 'Ismailia',
+    '21': 'Giza',
+    '22': 'Beni Suef',
+    '23': 'Fayoum',
+    '24': 'El Menia',
+    '25': 'Assiut',
+    '26': 'Sohag',
+    '27': 'Qena',
+    '28': 'Aswan',
+    '29': 'Luxor',
+    '31': 'Red Sea',
+    '32': 'New Valley',
+    '33': 'Matrouh',
+    '34': 'North Sinai',
+    '35': 'South Sinai',
+    '88': 'Foreign'
+}
 
+# Same table as a tuple indexed by the integer code; unused codes are "Unknown"
+GOVERNORATE_BY_CODE = tuple(GOVERNORATES.get(f"{code:02d}", "Unknown") for code in range(100))
+
+# Function to decode the Egyptian ID number into (birth date, governorate, gender)
+# Pure function of the 14-digit string, so repeat scans of a card hit the cache
+@functools.lru_cache(maxsize=1024)
+def decode_egyptian_id(id_number):
     century_digit = int(id_number[0])
     year = int(id_number[1:3])
     month = int(id_number[3:5])
     day = int(id_number[5:7])
-    governorate_code = id_number[7:9]
+    governorate_code = int(id_number[7:9])
     gender_code = int(id_number[12:13])
 
     if century_digit == 2:
@@ -154,34 +281,83 @@ def decode_egyptian_id(id_number):
         raise ValueError("Invalid century digit")
 
     gender = "Male" if gender_code % 2 != 0 else "Female"
-    governorate = governorates.get(governorate_code, "Unknown")
+    governorate = GOVERNORATE_BY_CODE[governorate_code]
     birth_date = f"{full_year:04d}-{month:02d}-{day:02d}"
 
-    return {
-        'Birth Date': birth_date,
-        'Governorate': governorate,
-        'Gender': gender
-    }
+    return birth_date, governorate, gender
 
-# Function to detect the ID card and pass it to the existing code
-def detect_and_process_id_card(image_path):
-    # Load the ID card detection model
-    id_card_model = YOLO('detect_id_card.pt')
+# EXIF Orientation tag values -> how to turn the decoded pixels upright
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_FIXES = {
+    2: lambda img: cv2.flip(img, 1),
+    3: lambda img: cv2.rotate(img, cv2.ROTATE_180),
+    4: lambda img: cv2.flip(img, 0),
+    5: lambda img: cv2.transpose(img),
+    6: lambda img: cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE),
+    7: lambda img: cv2.flip(cv2.transpose(img), -1),
+    8: lambda img: cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE),
+}
+
+# Function to read the EXIF orientation; Image.open only parses the header here
+def read_orientation(image_bytes):
+    try:
+        return Image.open(io.BytesIO(image_bytes)).getexif().get(EXIF_ORIENTATION, 1)
+    except OSError:
+        return 1
+
+# Function to decode encoded image bytes (JPEG/PNG/...) into a BGR array in memory
+# JPEGs (camera captures, most uploads) go through libjpeg-turbo via simplejpeg
+def decode_image(image_bytes):
+    image = None
+    if image_bytes[:3] == b"\xff\xd8\xff":
+        try:
+            image = simplejpeg.decode_jpeg(image_bytes, colorspace="BGR", fastdct=True, fastupsample=True)
+        except ValueError:
+            pass  # e.g. CMYK JPEGs; let OpenCV try
+    if image is None:
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        raise ValueError("Could not decode the image file")
+
+    # Phone photos are often stored sideways with an orientation tag; a rotated
+    # card makes YOLO/EasyOCR fail, so turn it upright (no-op for orientation 1)
+    fix = ORIENTATION_FIXES.get(read_orientation(image_bytes))
+    return fix(image) if fix else image
 
-    # Perform inference to detect the ID card
-    id_card_results = id_card_model(image_path)
+# Input size the ID card detector was trained at
+DETECT_SIZE = 640
 
-    # Load the original image using OpenCV
-    image = cv2.imread(image_path)
+# Function to detect the ID card and pass it to the existing code
+# `image` is a BGR numpy array (see decode_image), a PIL image or a file path;
+# in-memory callers skip the file round-trip entirely
+def detect_and_process_id_card(image, use_gpu=GPU_AVAILABLE):
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, 'rb') as f:
+            image = decode_image(f.read())
+    elif isinstance(image, Image.Image):
+        image = cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+
+    # Perform inference to detect the ID card on a copy shrunk to the detector's
+    # input size (aspect ratio kept); camera frames are often several times larger
+    height, width = image.shape[:2]
+    scale = min(1.0, DETECT_SIZE / max(height, width))
+    if scale < 1.0:
+        small = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    else:
+        small = image
+    id_card_results = predict('detect_id_card.pt', small, use_gpu, imgsz=DETECT_SIZE)
 
-    # Crop the ID card from the image
-    for result in id_card_results:
-        for box in result.boxes:
-            x1, y1, x2, y2 = map(int, box.xyxy[0])  # Get bounding box coordinates
-            cropped_image = image[y1:y2, x1:x2]
+    # Crop the most confident ID card box from the full-resolution image, so
+    # the OCR steps still see every pixel
+    boxes = id_card_results[0].boxes
+    if len(boxes) == 0:
+        raise ValueError("No ID card detected in the image")
+    best = int(boxes.conf.argmax())
+    x1, y1, x2, y2 = (boxes.xyxy[best].cpu().numpy() / scale).astype(int)  # Get bounding box coordinates
+    cropped_image = image[y1:y2, x1:x2]
 
     # Pass the cropped image to the existing processing function
-    return process_image(cropped_image)
+    return process_image(cropped_image, use_gpu)
 
 # print(detect_and_process_id_card("font_ID.jpg"))
 